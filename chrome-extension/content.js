@@ -194,36 +194,34 @@ async function captureAndSendImage(video) {
       userEmail: userEmail
     });
     
-    // Convert image to data URL - use high quality for better face detection
-    let imageData;
+    // Encode the frame as a JPEG blob - use high quality for better face detection
+    let imageBlob;
     try {
-      imageData = canvas.toDataURL('image/jpeg', 0.95); // Higher quality for better face detection
-      debugLog('Image converted to data URL', { 
-        length: imageData.length
+      imageBlob = await new Promise(resolve => canvas.toBlob(resolve, 'image/jpeg', 0.95));
+      if (!imageBlob) {
+        throw new Error('canvas.toBlob returned no data');
+      }
+      debugLog('Image converted to JPEG blob', { 
+        size: imageBlob.size
       });
     } catch (imageError) {
-      debugLog('ERROR converting image to data URL:', imageError);
+      debugLog('ERROR converting image to JPEG:', imageError);
       return;
     }
     
-    // Prepare payload with all required fields
-    const payload = {
-      imageData: imageData,
-      meetingId,
-      timestamp,
-      userName: userEmail, // Using email as the user name
-      userId: userEmail    // Using email as the user ID
-    };
-    
     debugLog('Sending data to server');
     try {
-      const response = await fetch(BACKEND_URL, {
+      // Send the raw JPEG; meeting metadata goes in headers
+      const response = await fetch(`${BACKEND_URL}/bin`, {
         method: 'POST',
         headers: {
-          'Content-Type': 'application/json',
-          'Accept': 'application/json'
+          'Content-Type': 'image/jpeg',
+          'Accept': 'application/json',
+          'X-Meeting-Id': meetingId,
+          'X-User-Email': userEmail,
+          'X-Timestamp': timestamp
         },
-        body: JSON.stringify(payload)
+        body: imageBlob
       });
       
       if (response.ok) {
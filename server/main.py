@@ -2,16 +2,22 @@ from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 from datetime import datetime
+import asyncio
 import base64
+import hashlib
+import logging
 import os
 import json
 from typing import Optional
 import cv2
 import numpy as np
-from collections import defaultdict, deque
 import sqlite3
-from fastapi.responses import HTMLResponse, JSONResponse
-from fastapi import Request, Query
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from fastapi.responses import HTMLResponse, JSONResponse, Response
+from fastapi import Request, Query, Header
 import csv
 from io import StringIO
 from dotenv import load_dotenv
@@ -20,10 +26,16 @@ from fastapi.staticfiles import StaticFiles
 # Load environment variables
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
 # Configuration from environment variables
 DB_PATH = os.getenv('DB_PATH', 'attention_scores.db')
 IMAGES_DIR = os.getenv('IMAGES_DIR', 'images')
 MEETING_DATA_DIR = os.getenv('MEETING_DATA_DIR', 'meeting_data')
+USE_OPENCL = os.getenv('USE_OPENCL', 'true').lower() in ('1', 'true', 'yes')
+# Detection processes per server process. Kept small by default: gunicorn runs
+# several server processes, and os.cpu_count() reports host cores in containers.
+DETECT_WORKERS = int(os.getenv('DETECT_WORKERS', 2))
 PORT = int(os.getenv('PORT', 3000))
 HOST = os.getenv('HOST', '0.0.0.0')
 ALLOWED_ORIGINS = os.getenv('ALLOWED_ORIGINS', 'chrome-extension://*').split(',')
@@ -39,6 +51,12 @@ STATIC_IMAGES_DIR = os.path.join(os.path.dirname(__file__), "images")
 
 app.mount("/images", StaticFiles(directory=STATIC_IMAGES_DIR), name="images")
 
+# The attention lookup page is static; read it once and let browsers cache it
+with open(os.path.join(os.path.dirname(__file__), "static", "db_attention.html"), "rb") as f:
+    DB_ATTENTION_PAGE_BYTES = f.read()
+DB_ATTENTION_PAGE_ETAG = '"%s"' % hashlib.md5(DB_ATTENTION_PAGE_BYTES).hexdigest()
+DB_ATTENTION_PAGE_HEADERS = {"Cache-Control": "public, max-age=3600", "ETag": DB_ATTENTION_PAGE_ETAG}
+
 # Enable CORS for the Chrome extension
 app.add_middleware(
     CORSMiddleware,
@@ -54,46 +72,265 @@ app.add_middleware(
 os.makedirs(IMAGES_DIR, exist_ok=True)
 os.makedirs(MEETING_DATA_DIR, exist_ok=True)
 
-# In-memory attention tracking: { (meetingId, userId): deque([0/1,...]) }
-ATTENTION_HISTORY = defaultdict(lambda: deque(maxlen=30))  # last 30 frames
-# Short-term buffer for robust detection
-SHORT_TERM_HISTORY = defaultdict(lambda: deque(maxlen=5))  # last 5 frames
+class Histories:
+    """Ring buffers of recent attention percentages, one row per (meetingId, userEmail).
 
-# Load Haar cascades for face and eyes (use a more robust frontal face model)
-face_cascade = cv2.CascadeClassifier(cv2.data.haarcascades + 'haarcascade_frontalface_alt2.xml')
-eye_cascade = cv2.CascadeClassifier(cv2.data.haarcascades + 'haarcascade_eye.xml')
-profile_cascade = cv2.CascadeClassifier(cv2.data.haarcascades + 'haarcascade_profileface.xml')
+    Scores live in one contiguous matrix with per-row head, count and running
+    sum arrays, so the average of a row is a single division.
+    """
+
+    def __init__(self, capacity, window):
+        self.window = window
+        self.buf = np.zeros((capacity, window), np.uint8)
+        self.head = np.zeros(capacity, np.int32)
+        self.count = np.zeros(capacity, np.int32)
+        self.sum = np.zeros(capacity, np.int64)
+        self.key2row = {}
+
+    def _grow(self):
+        capacity = len(self.buf) * 2
+        self.buf = np.concatenate([self.buf, np.zeros_like(self.buf)])
+        self.head = np.resize(self.head, capacity)
+        self.count = np.resize(self.count, capacity)
+        self.sum = np.resize(self.sum, capacity)
+        n = len(self.key2row)
+        self.head[n:] = 0
+        self.count[n:] = 0
+        self.sum[n:] = 0
+
+    def push(self, key, value):
+        row = self.key2row.get(key)
+        if row is None:
+            row = len(self.key2row)
+            if row == len(self.buf):
+                self._grow()
+            self.key2row[key] = row
+        h = self.head[row]
+        self.sum[row] += value - int(self.buf[row, h])
+        self.buf[row, h] = value
+        self.head[row] = (h + 1) % self.window
+        if self.count[row] < self.window:
+            self.count[row] += 1
+
+# In-memory attention tracking: last 30 frames per (meetingId, userEmail)
+ATTENTION_HISTORY = Histories(capacity=1024, window=30)
+
+# Haar cascades for face and eyes. Detection runs in a process pool and the
+# classifiers can't be pickled, so each worker loads its own copy in _init_worker.
+face_cascade = None
+eye_cascade = None
+profile_cascade = None
+
+# Frames are downscaled to this width before face detection
+DETECT_WIDTH = 320
+# Largest face searched for at DETECT_WIDTH; bigger faces fill most of the frame
+FACE_MAX_SIZE = (200, 200)
+# Base window size of haarcascade_eye.xml
+EYE_MIN_WINDOW = 20
+# Per-worker reusable buffers for downscaled frames, keyed by (width, height)
+SCRATCH_BUFFERS = {}
+# Frames whose 64-bit average hash differs from the last analysed frame in
+# fewer bits than this are treated as unchanged
+MOTION_THRESHOLD = 6
+# Gaze changes don't show up in the hash, so re-run detection after this many
+# consecutive reused scores even if the frame still looks unchanged
+MOTION_MAX_SKIPS = 5
+
+# Last analysed frame per (meetingId, userEmail): (hash, raw score, frames
+# reused since), LRU-bounded
+LAST_FRAMES = OrderedDict()
+LAST_FRAMES_MAX = 4096
+
+# Process pool for detect_attention, created on startup
+POOL = None
+
+def new_pool():
+    return ProcessPoolExecutor(max_workers=DETECT_WORKERS, initializer=_init_worker)
+
+def replace_broken_pool(broken):
+    # Concurrent frames can all see the same broken pool; replace it only once
+    global POOL
+    if POOL is broken:
+        logger.warning("Detection worker died; restarting the process pool")
+        broken.shutdown(wait=False)
+        POOL = new_pool()
+
+def _init_worker():
+    global face_cascade, eye_cascade, profile_cascade
+    # Many workers share the CPU; OpenCV's own threading only adds contention
+    cv2.setNumThreads(1)
+    # Let whole-frame passes run on an OpenCL device when one is present
+    cv2.ocl.setUseOpenCL(USE_OPENCL and cv2.ocl.haveOpenCL())
+    # Use a more robust frontal face model
+    face_cascade = cv2.CascadeClassifier(cv2.data.haarcascades + 'haarcascade_frontalface_alt2.xml')
+    eye_cascade = cv2.CascadeClassifier(cv2.data.haarcascades + 'haarcascade_eye.xml')
+    profile_cascade = cv2.CascadeClassifier(cv2.data.haarcascades + 'haarcascade_profileface.xml')
 
 # --- SQLite setup ---
+# A single connection is shared by all handlers; sqlite3 connections are not
+# safe to use from several threads at once, so every access goes through DB_LOCK.
+DB_LOCK = threading.Lock()
+
+# Statements are kept as module constants so every call passes the identical
+# string and hits the connection's prepared-statement cache
+SQL_INSERT_HISTORY = "INSERT INTO attention_history (meeting_id, user_email, timestamp, attention) VALUES (?, ?, ?, ?)"
+SQL_UPSERT_SCORE = '''
+    INSERT INTO attention_scores (meeting_id, user_email, date, attention, updated_at, attention_sum, attention_count)
+    VALUES (?, ?, ?, ?, ?, ?, 1)
+    ON CONFLICT(meeting_id, user_email, date) DO UPDATE SET
+        attention_sum=attention_sum + excluded.attention_sum,
+        attention_count=attention_count + 1,
+        attention=(attention_sum + excluded.attention_sum) * 1.0 / (attention_count + 1),
+        updated_at=excluded.updated_at
+'''
+SQL_SELECT_SCORES = "SELECT user_email, attention_sum, attention_count FROM attention_scores WHERE meeting_id=?"
+SQL_SELECT_USER_SCORE = "SELECT attention_sum, attention_count FROM attention_scores WHERE meeting_id=? AND user_email=?"
+SQL_SELECT_HISTORY = "SELECT timestamp, attention FROM attention_history WHERE meeting_id=? AND user_email=? ORDER BY timestamp ASC"
+
+# Schema version kept in PRAGMA user_version. Version 1 stores attention as
+# integer percentages; older databases are converted by migrate_db.py, which
+# is run once with the server stopped rather than at startup.
+SCHEMA_VERSION = 1
+
 def init_db():
-    conn = sqlite3.connect(DB_PATH)
+    conn = sqlite3.connect(DB_PATH, check_same_thread=False, isolation_level=None, cached_statements=256)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.execute('PRAGMA temp_store=MEMORY')
+    conn.execute('PRAGMA cache_size=-64000')
     c = conn.cursor()
-    c.execute('''
-        CREATE TABLE IF NOT EXISTS attention_scores (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            meeting_id TEXT NOT NULL,
-            user_email TEXT NOT NULL,
-            date TEXT NOT NULL,
-            attention REAL,
-            updated_at TEXT,
-            attention_sum REAL DEFAULT 0,
-            attention_count INTEGER DEFAULT 0,
-            UNIQUE(meeting_id, user_email, date)
+    # Create the tables and stamp a new database's version in one transaction,
+    # so a process starting alongside never sees the tables without a version
+    c.execute('BEGIN IMMEDIATE')
+    try:
+        existing = c.execute('''
+            SELECT COUNT(*) FROM sqlite_master
+            WHERE type='table' AND name IN ('attention_scores', 'attention_history')
+        ''').fetchone()[0]
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS attention_scores (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                meeting_id TEXT NOT NULL,
+                user_email TEXT NOT NULL,
+                date TEXT NOT NULL,
+                attention REAL,
+                updated_at TEXT,
+                attention_sum INTEGER DEFAULT 0,
+                attention_count INTEGER DEFAULT 0,
+                UNIQUE(meeting_id, user_email, date)
+            )
+        ''')
+        # New table for attention history (per image)
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS attention_history (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                meeting_id TEXT NOT NULL,
+                user_email TEXT NOT NULL,
+                timestamp TEXT NOT NULL,
+                attention INTEGER NOT NULL
+            )
+        ''')
+        if not existing:
+            c.execute(f'PRAGMA user_version={SCHEMA_VERSION}')
+        version = c.execute('PRAGMA user_version').fetchone()[0]
+        c.execute('COMMIT')
+    except Exception:
+        c.execute('ROLLBACK')
+        raise
+    if version < SCHEMA_VERSION:
+        conn.close()
+        raise RuntimeError(
+            f"{DB_PATH} uses schema version {version}, expected {SCHEMA_VERSION}. "
+            "Stop the server and run `python server/migrate_db.py` to convert it."
         )
-    ''')
-    # New table for attention history (per image)
+    # Graph lookups filter on meeting/user and sort by time; this index serves
+    # both without a table scan or sort. attention_scores lookups are already
+    # covered by the leading columns of its UNIQUE(meeting_id, user_email, date).
     c.execute('''
-        CREATE TABLE IF NOT EXISTS attention_history (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            meeting_id TEXT NOT NULL,
-            user_email TEXT NOT NULL,
-            timestamp TEXT NOT NULL,
-            attention REAL NOT NULL
-        )
+        CREATE INDEX IF NOT EXISTS ix_hist_mid_uemail_ts
+        ON attention_history(meeting_id, user_email, timestamp)
     ''')
-    conn.commit()
-    conn.close()
-init_db()
+    # Refresh planner statistics; the limit keeps this quick on large tables
+    c.execute('PRAGMA analysis_limit=1000')
+    c.execute('ANALYZE')
+    return conn
+DB = init_db()
+app.state.db = DB
+app.state.db_lock = DB_LOCK
+
+# --- Batched writes ---
+# Frames only enqueue their rows; a background task commits them in batches so
+# request handlers never wait on SQLite.
+FLUSH_INTERVAL = 0.1  # seconds to wait for more rows before committing
+FLUSH_MAX_ROWS = 500
+WRITE_Q = None
+FLUSHER_TASK = None
+
+
+def write_batch(rows):
+    # rows: (meeting_id, user_email, timestamp, attention, date, updated_at)
+    history_rows = [(m, u, ts, att) for m, u, ts, att, _, _ in rows]
+    score_rows = [
+        (m, u, day, att, now_iso, att)
+        for m, u, _, att, day, now_iso in rows
+        if u and u != "unknown"
+    ]
+    with DB_LOCK:
+        DB.execute("BEGIN IMMEDIATE")
+        try:
+            # --- Store attention history for graph ---
+            DB.executemany(SQL_INSERT_HISTORY, history_rows)
+            # --- SQLite upsert for running average ---
+            DB.executemany(SQL_UPSERT_SCORE, score_rows)
+            DB.execute("COMMIT")
+        except Exception:
+            DB.execute("ROLLBACK")
+            raise
+
+async def flusher():
+    # Runs until it takes None off the queue, writing everything before it
+    loop = asyncio.get_running_loop()
+    stopping = False
+    while not stopping:
+        row = await WRITE_Q.get()
+        if row is None:
+            break
+        rows = [row]
+        deadline = loop.time() + FLUSH_INTERVAL
+        while len(rows) < FLUSH_MAX_ROWS:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            try:
+                row = await asyncio.wait_for(WRITE_Q.get(), remaining)
+            except asyncio.TimeoutError:
+                break
+            if row is None:
+                stopping = True
+                break
+            rows.append(row)
+        try:
+            await loop.run_in_executor(None, write_batch, rows)
+        except Exception:
+            logger.exception("Failed to write %d attention rows", len(rows))
+
+@app.on_event("startup")
+async def start_background_workers():
+    global WRITE_Q, FLUSHER_TASK, POOL
+    WRITE_Q = asyncio.Queue()
+    FLUSHER_TASK = asyncio.create_task(flusher())
+    POOL = new_pool()
+
+@app.on_event("shutdown")
+async def stop_background_workers():
+    POOL.shutdown(wait=True)
+    # Frames already queued come before the sentinel, so they all get written
+    await WRITE_Q.put(None)
+    await FLUSHER_TASK
+    # Fold the WAL back into the main database file before exiting
+    with DB_LOCK:
+        DB.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        DB.close()
 
 class ImageData(BaseModel):
     imageData: str
@@ -102,31 +339,87 @@ class ImageData(BaseModel):
     userId: Optional[str] = None  # Using userId for email now
     userName: Optional[str] = None  # Using userName for email as fallback
 
-def detect_attention(image_bytes):
+def frame_hash(gray):
+    # Average hash: 8x8 thumbnail thresholded at its mean, packed into 64 bits
+    thumb = cv2.resize(gray, (8, 8), interpolation=cv2.INTER_AREA)
+    return int.from_bytes(np.packbits(thumb > thumb.mean()).tobytes(), 'big')
+
+def detect_attention(image_bytes, prev_hash=None, prev_score=0):
+    """Return (attention, hash of the last analysed frame).
+
+    Frames that barely differ from the previously analysed one reuse its
+    score instead of running the cascades again.
+    """
     nparr = np.frombuffer(image_bytes, np.uint8)
-    img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-    if img is None:
-        return 0
+    # Decode straight to grayscale at half resolution; libjpeg scales in the
+    # DCT domain, so there is no colour image or cvtColor pass at all
+    gray = cv2.imdecode(nparr, cv2.IMREAD_REDUCED_GRAYSCALE_2)
+    if gray is None:
+        return 0, None
+    decode_scale = 2
+    # Sources under 2 * DETECT_WIDTH would land below the detection width,
+    # shrinking faces relative to minSize; decode those at full size instead
+    if gray.shape[1] < DETECT_WIDTH:
+        gray = cv2.imdecode(nparr, cv2.IMREAD_GRAYSCALE)
+        decode_scale = 1
     
-    # Convert to grayscale and enhance contrast
-    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-    gray = cv2.equalizeHist(gray)
+    current_hash = frame_hash(gray)
+    if prev_hash is not None and bin(current_hash ^ prev_hash).count('1') < MOTION_THRESHOLD:
+        return prev_score, prev_hash
+    return score_frame(gray, decode_scale), current_hash
+
+def scratch_buffer(size):
+    # Webcam streams keep a constant frame size, so reusing one buffer per
+    # size avoids allocating the downscaled frame on every call
+    buf = SCRATCH_BUFFERS.get(size)
+    if buf is None:
+        if len(SCRATCH_BUFFERS) >= 8:
+            SCRATCH_BUFFERS.clear()
+        buf = SCRATCH_BUFFERS[size] = np.empty((size[1], size[0]), np.uint8)
+    return buf
+
+def score_frame(gray, decode_scale=1):
+    img_height, img_width = gray.shape
+
+    # With a UMat input OpenCV dispatches to OpenCL (T-API); otherwise plain CPU
+    # and the decoded frame is equalized in place (it isn't needed afterwards)
+    if cv2.ocl.useOpenCL():
+        src = cv2.equalizeHist(cv2.UMat(gray))
+    else:
+        src = cv2.equalizeHist(gray, dst=gray)
+
+    # Cascade cost grows with pixel count, so search for faces on a downscaled copy
+    scale = min(1.0, DETECT_WIDTH / img_width)
+    if scale < 1.0:
+        size = (DETECT_WIDTH, int(img_height * scale))
+        if isinstance(src, cv2.UMat):
+            small = cv2.resize(src, size, interpolation=cv2.INTER_AREA)
+        else:
+            small = cv2.resize(src, size, dst=scratch_buffer(size), interpolation=cv2.INTER_AREA)
+    else:
+        small = src
 
-    # Try to detect frontal face first
-    faces = face_cascade.detectMultiScale(gray, scaleFactor=1.1, minNeighbors=3)
+    # Try to detect frontal face first; maxSize bounds the pyramid from above
+    faces = face_cascade.detectMultiScale(
+        small, scaleFactor=1.2, minNeighbors=3, minSize=(30, 30), maxSize=FACE_MAX_SIZE
+    )
     face_score = 0
     
     # If no frontal face, try profile face
     if len(faces) == 0:
-        faces = profile_cascade.detectMultiScale(gray, scaleFactor=1.1, minNeighbors=3)
+        faces = profile_cascade.detectMultiScale(
+            small, scaleFactor=1.2, minNeighbors=3, minSize=(30, 30), maxSize=FACE_MAX_SIZE
+        )
         if len(faces) > 0:
             face_score = 0.5  # Profile face detected, partial score
     
     if len(faces) == 0:
         return 0  # No face detected
 
+    # Map face rectangles back to decoded resolution for the eye search
+    faces = [(int(x / scale), int(y / scale), int(w / scale), int(h / scale)) for (x, y, w, h) in faces]
+
     # Calculate face position score
-    img_height, img_width = gray.shape
     face_scores = []
     
     for (x, y, w, h) in faces:
@@ -148,11 +441,28 @@ def detect_attention(image_bytes):
     # Get the best face score
     face_score = max(face_scores) if face_scores else 0
 
+    # Eye ROIs are sliced with numpy indexing, which needs a host array
+    gray = src.get() if isinstance(src, cv2.UMat) else src
+
     # Eye detection and scoring
     eye_scores = []
     for (x, y, w, h) in faces:
-        roi_gray = gray[y:y+h, x:x+w]
-        eyes = eye_cascade.detectMultiScale(roi_gray, scaleFactor=1.1, minNeighbors=3)
+        # Eyes sit in the upper part of the face; skipping the rest shrinks the
+        # search and avoids nostrils/mouth being picked up as eyes
+        roi_gray = gray[y:y+int(h * 0.6), x:x+w]
+        face_w = w
+        # Eyes are only a few pixels wide on a reduced decode; bring the small
+        # face region back up to source scale so they fit the 20x20 cascade
+        if decode_scale > 1:
+            roi_gray = cv2.resize(roi_gray, None, fx=decode_scale, fy=decode_scale, interpolation=cv2.INTER_LINEAR)
+            face_w = w * decode_scale
+        # The eye cascade's window is 20x20 and OpenCV stops once it exceeds
+        # maxSize, so never bound it below that or small faces get no scan
+        eye_max = max(face_w // 2, EYE_MIN_WINDOW)
+        eyes = eye_cascade.detectMultiScale(
+            roi_gray, scaleFactor=1.1, minNeighbors=3,
+            minSize=(face_w // 8, face_w // 8), maxSize=(eye_max, eye_max)
+        )
         
         if len(eyes) == 0:
             continue
@@ -165,11 +475,15 @@ def detect_attention(image_bytes):
             threshold = int(mean_intensity * 0.7)
             _, thresh = cv2.threshold(eye_img, threshold, 255, cv2.THRESH_BINARY_INV)
             
-            # Find pupil position
-            ys, xs = np.where(thresh == 255)
-            if len(xs) > 0:
-                cx = np.mean(xs)
-                cy = np.mean(ys)
+            # Find pupil position as the centroid of the dark pixels, using the
+            # row/column sums of the mask instead of materialising every index
+            mask = thresh > 0
+            col_weights = mask.sum(axis=0, dtype=np.float32)
+            total = col_weights.sum()
+            if total > 0:
+                row_weights = mask.sum(axis=1, dtype=np.float32)
+                cx = np.dot(col_weights, np.arange(ew, dtype=np.float32)) / total
+                cy = np.dot(row_weights, np.arange(eh, dtype=np.float32)) / total
                 
                 # Calculate how centered the pupil is
                 center_x = ew / 2
@@ -191,86 +505,85 @@ def detect_attention(image_bytes):
         # If no eyes detected but face is present, return partial score
         return float(face_score * 0.4)
 
-@app.post("/api/images")
-async def receive_image(data: ImageData):
-    try:
-        image_data = data.imageData.split(',')[1]
-        image_bytes = base64.b64decode(image_data)
-        timestamp = datetime.fromisoformat(data.timestamp.replace('Z', '+00:00'))
-        
-        # Get user email - prioritize userId, fallback to userName
-        user_email = data.userId or data.userName or "unknown"
-        
+async def process_frame(meeting_id, user_email, timestamp_str, image_bytes):
+    timestamp = datetime.fromisoformat(timestamp_str.replace('Z', '+00:00'))
+    
+    # Record the meeting the first time it is seen rather than on every frame
+    meeting_data_path = os.path.join(MEETING_DATA_DIR, f"{meeting_id}.json")
+    if not os.path.exists(meeting_data_path):
         meeting_data = {
-            "meetingId": data.meetingId,
+            "meetingId": meeting_id,
             "userEmail": user_email,
-            "timestamp": data.timestamp,
+            "timestamp": timestamp_str,
         }
-        meeting_data_path = os.path.join(MEETING_DATA_DIR, f"{data.meetingId}.json")
         with open(meeting_data_path, 'w') as f:
             json.dump(meeting_data, f, indent=2)
-        
-        # --- Attention detection ---
-        key = (data.meetingId, user_email)
-        raw_attention = detect_attention(image_bytes)
-        
-        # Store the continuous attention score directly
-        attention = raw_attention
-        
-        # Store userEmail in a parallel dict for display
-        if not hasattr(receive_image, 'user_emails'):
-            receive_image.user_emails = {}
-        
-        receive_image.user_emails[key] = user_email
-        ATTENTION_HISTORY[key].append(attention)
-        
-        # --- Store attention history for graph ---
-        conn = sqlite3.connect(DB_PATH)
-        c = conn.cursor()
-        c.execute(
-            "INSERT INTO attention_history (meeting_id, user_email, timestamp, attention) VALUES (?, ?, ?, ?)",
-            (data.meetingId, user_email, data.timestamp, float(attention))
+    
+    # --- Attention detection ---
+    key = (meeting_id, user_email)
+    prev_hash, prev_score, skipped = LAST_FRAMES.get(key, (None, 0, 0))
+    if skipped >= MOTION_MAX_SKIPS:
+        prev_hash = None  # force a full analysis
+    loop = asyncio.get_running_loop()
+    pool = POOL
+    try:
+        raw_attention, last_hash = await loop.run_in_executor(
+            pool, detect_attention, image_bytes, prev_hash, prev_score
         )
-        conn.commit()
-        conn.close()
+    except BrokenProcessPool:
+        # A worker crashed (e.g. inside OpenCV); every later submit to this
+        # pool would fail, so swap in a fresh one for the next frames. This
+        # frame is the likely cause of the crash, so it is not retried.
+        replace_broken_pool(pool)
+        raise
+    # An unchanged hash means the worker reused prev_score
+    skipped = skipped + 1 if prev_hash is not None and last_hash == prev_hash else 0
+    LAST_FRAMES[key] = (last_hash, raw_attention, skipped)
+    LAST_FRAMES.move_to_end(key)
+    if len(LAST_FRAMES) > LAST_FRAMES_MAX:
+        LAST_FRAMES.popitem(last=False)
+    
+    # Keep attention as an integer percentage from here on
+    attention = min(100, max(0, round(raw_attention * 100)))
+    
+    ATTENTION_HISTORY.push(key, attention)
+    
+    today = timestamp.strftime('%Y-%m-%d')
+    now_iso = datetime.now().isoformat()
+    await WRITE_Q.put((meeting_id, user_email, timestamp_str, attention, today, now_iso))
+    
+    return {
+        "status": "success",
+        "message": "Image processed and not stored",
+        "attention": attention / 100
+    }
+
+@app.post("/api/images")
+async def receive_image(data: ImageData):
+    try:
+        # Drop the "data:image/...;base64," prefix
+        image_bytes = base64.b64decode(data.imageData[data.imageData.index(',') + 1:])
         
-        # --- SQLite upsert for running average ---
-        if user_email and user_email != "unknown":
-            conn = sqlite3.connect(DB_PATH)
-            c = conn.cursor()
-            today = timestamp.strftime('%Y-%m-%d')
-            now_iso = datetime.now().isoformat()
-            
-            # Try to update first
-            c.execute('''
-                SELECT attention_sum, attention_count FROM attention_scores
-                WHERE meeting_id=? AND user_email=? AND date=?
-            ''', (data.meetingId, user_email, today))
-            
-            row = c.fetchone()
-            if row:
-                new_sum = row[0] + float(attention)
-                new_count = row[1] + 1
-                avg = new_sum / new_count
-                c.execute('''
-                    UPDATE attention_scores
-                    SET attention=?, attention_sum=?, attention_count=?, updated_at=?
-                    WHERE meeting_id=? AND user_email=? AND date=?
-                ''', (avg, new_sum, new_count, now_iso, data.meetingId, user_email, today))
-            else:
-                c.execute('''
-                    INSERT INTO attention_scores (meeting_id, user_email, date, attention, updated_at, attention_sum, attention_count)
-                    VALUES (?, ?, ?, ?, ?, ?, ?)
-                ''', (data.meetingId, user_email, today, float(attention), now_iso, float(attention), 1))
-            
-            conn.commit()
-            conn.close()
+        # Get user email - prioritize userId, fallback to userName
+        user_email = data.userId or data.userName or "unknown"
         
-        return {
-            "status": "success",
-            "message": "Image processed and not stored",
-            "attention": attention
-        }
+        return await process_frame(data.meetingId, user_email, data.timestamp, image_bytes)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/api/images/bin")
+async def receive_image_bin(
+    request: Request,
+    x_meeting_id: str = Header(...),
+    x_timestamp: str = Header(...),
+    x_user_email: Optional[str] = Header(None),
+):
+    # Same as /api/images, but the body is the raw encoded image and the
+    # metadata travels in headers, so there is no base64 to decode
+    try:
+        image_bytes = await request.body()
+        user_email = x_user_email or "unknown"
+        return await process_frame(x_meeting_id, user_email, x_timestamp, image_bytes)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -280,448 +593,55 @@ async def health_check():
 
 @app.get("/api/attention")
 async def get_attention_scores():
-    result = []
-    user_emails = getattr(receive_image, 'user_emails', {})
+    # Average every row in one pass; stored values are percentages
+    n = len(ATTENTION_HISTORY.key2row)
+    avgs = ATTENTION_HISTORY.sum[:n] / np.maximum(ATTENTION_HISTORY.count[:n], 1) / 100
     
-    for (meetingId, userEmail), history in ATTENTION_HISTORY.items():
-        if history:
-            avg_attention = sum(history) / len(history)
-        else:
-            avg_attention = 0.0
-        
-        result.append({
+    return [
+        {
             "meetingId": meetingId,
             "userEmail": userEmail,
-            "attention_score": round(avg_attention, 2)
-        })
-    
-    return result
+            "attention_score": round(float(avgs[row]), 2)
+        }
+        for (meetingId, userEmail), row in ATTENTION_HISTORY.key2row.items()
+    ]
 
 @app.get("/api/db-attention", response_class=HTMLResponse)
-async def db_attention_page():
-    return """
-    <html>
-    <head>
-        <title>Attention Scores Lookup</title>
-        <script src='https://cdn.jsdelivr.net/npm/chart.js'></script>
-        <style>
-            /* Modern CSS Reset */
-            *, *::before, *::after {
-                box-sizing: border-box;
-                margin: 0;
-                padding: 0;
-            }
-
-            body {
-                font-family: 'Inter', -apple-system, BlinkMacSystemFont, 'Segoe UI', Roboto, sans-serif;
-                background: linear-gradient(135deg, #2c3e50 0%, #3498db 100%);
-                min-height: 100vh;
-                display: flex;
-                justify-content: center;
-                align-items: center;
-                padding: 2rem;
-                color: #2c3e50;
-            }
-
-            .container {
-                background: rgba(255, 255, 255, 0.95);
-                border-radius: 20px;
-                padding: 2.5rem;
-                width: 100%;
-                max-width: 900px;
-                box-shadow: 0 10px 30px rgba(0, 0, 0, 0.2);
-                backdrop-filter: blur(10px);
-            }
-
-            h2 {
-                text-align: center;
-                font-size: 2.5rem;
-                color: #2c3e50;
-                margin-bottom: 1.5rem;
-                font-weight: 700;
-            }
-
-            .logo-container {
-                text-align: center;
-                margin-bottom: 2rem;
-            }
-
-            .logo-container img {
-                max-width: 150px;
-                height: auto;
-                border-radius: 10px;
-                box-shadow: 0 4px 10px rgba(0, 0, 0, 0.1);
-            }
-
-            form {
-                margin-bottom: 2rem;
-                text-align: center;
-            }
-
-            form label {
-                display: block;
-                margin-bottom: 0.5rem;
-                font-weight: 600;
-                color: #2c3e50;
-            }
-
-            form input[type='text'] {
-                width: 100%;
-                max-width: 400px;
-                padding: 1rem 1.5rem;
-                border: 2px solid #e0e0e0;
-                border-radius: 12px;
-                font-size: 1rem;
-                transition: all 0.3s ease;
-                background: white;
-                margin-bottom: 1rem;
-            }
-
-            form input[type='text']:focus {
-                outline: none;
-                border-color: #3498db;
-                box-shadow: 0 0 0 3px rgba(52, 152, 219, 0.2);
-            }
-
-            form button {
-                padding: 1rem 2rem;
-                background: linear-gradient(135deg, #3498db, #2980b9);
-                color: white;
-                border: none;
-                border-radius: 12px;
-                font-size: 1rem;
-                font-weight: 600;
-                cursor: pointer;
-                transition: all 0.3s ease;
-            }
-
-            form button:hover {
-                transform: translateY(-2px);
-                box-shadow: 0 5px 15px rgba(52, 152, 219, 0.3);
-            }
-
-            table {
-                width: 100%;
-                border-collapse: separate;
-                border-spacing: 0;
-                margin-top: 1.5rem;
-                background: white;
-                border-radius: 12px;
-                overflow: hidden;
-                box-shadow: 0 4px 6px rgba(0, 0, 0, 0.1);
-            }
-
-            th, td {
-                padding: 1rem;
-                text-align: left;
-                border-bottom: 1px solid #e0e0e0;
-            }
-
-            th {
-                background: #f8f9fa;
-                font-weight: 600;
-                color: #2c3e50;
-            }
-
-            td {
-                color: #2c3e50;
-            }
-
-            tr:last-child td {
-                border-bottom: none;
-            }
-
-            tr:hover td {
-                background: #f8f9fa;
-            }
-
-            #results {
-                margin-top: 1.5rem;
-            }
-
-            #results p {
-                text-align: center;
-                color: #666;
-                font-style: italic;
-            }
-
-            /* Modal styles */
-            .modal {
-                display: none;
-                position: fixed;
-                z-index: 1000;
-                left: 0;
-                top: 0;
-                width: 100%;
-                height: 100%;
-                background: rgba(0, 0, 0, 0.5);
-                backdrop-filter: blur(5px);
-                overflow: hidden;
-            }
-
-            .modal-content {
-                background: white;
-                margin: 5% auto;
-                padding: 2rem;
-                width: 90%;
-                max-width: 800px;
-                max-height: 80vh;
-                border-radius: 20px;
-                position: relative;
-                box-shadow: 0 10px 30px rgba(0, 0, 0, 0.2);
-                display: flex;
-                flex-direction: column;
-            }
-
-            .modal-content h3 {
-                margin-bottom: 1rem;
-            }
-
-            .chart-container {
-                position: relative;
-                height: 400px;
-                width: 100%;
-                margin-top: 1rem;
-            }
-
-            .close {
-                position: absolute;
-                top: 1rem;
-                right: 1.5rem;
-                font-size: 1.5rem;
-                color: #666;
-                cursor: pointer;
-                transition: color 0.3s ease;
-            }
-
-            .close:hover {
-                color: #2c3e50;
-            }
-
-            /* Graph button styles */
-            button.view-graph {
-                padding: 0.5rem 1rem;
-                background: linear-gradient(135deg, #3498db, #2980b9);
-                color: white;
-                border: none;
-                border-radius: 8px;
-                cursor: pointer;
-                transition: all 0.3s ease;
-                font-size: 0.9rem;
-            }
-
-            button.view-graph:hover {
-                transform: translateY(-2px);
-                box-shadow: 0 4px 10px rgba(52, 152, 219, 0.3);
-            }
-
-            @media (max-width: 768px) {
-                .container {
-                    padding: 1.5rem;
-                }
-
-                form input[type='text'] {
-                    max-width: 100%;
-                }
-
-                table {
-                    display: block;
-                    overflow-x: auto;
-                }
-
-                .modal-content {
-                    margin: 10% auto;
-                    padding: 1.5rem;
-                }
-            }
-        </style>
-    </head>
-    <body>
-        <div class='container'>
-            <div class='logo-container'>
-                <img src='/images/logo_p.png' alt='Logo'>
-            </div>
-            <h2>Attention Scores Lookup</h2>
-            <form id='meet-form'>
-                <label for='meeting-id'>Meeting ID:</label>
-                <input type='text' id='meeting-id' name='meeting-id' placeholder="Enter meeting ID..." required>
-                <button type='submit'>Search</button>
-            </form>
-            <div id='results'></div>
-        </div>
-        <!-- Modal for graph -->
-        <div id="graphModal" class="modal">
-            <div class="modal-content">
-                <span class="close" id="closeModal">&times;</span>
-                <h3>Attention Graph</h3>
-                <div class="chart-container">
-                    <canvas id="attentionChart"></canvas>
-                </div>
-            </div>
-        </div>
-        <script>
-        let chartInstance = null;
-        document.getElementById('meet-form').onsubmit = async function(e) {
-            e.preventDefault();
-            const meetId = document.getElementById('meeting-id').value.trim();
-            if (!meetId) return;
-            document.getElementById('results').innerHTML = 'Loading...';
-            const dataUrl = `${window.location.origin}/api/db-attention-data?meeting_id=${encodeURIComponent(meetId)}`;
-            try {
-                const resp = await fetch(dataUrl);
-                if (!resp.ok) {
-                    throw new Error(`HTTP error! status: ${resp.status}`);
-                }
-                const data = await resp.json();
-                if (!data.length) {
-                    document.getElementById('results').innerHTML = '<p>No data found for this meeting ID.</p>';
-                    return;
-                }
-                let html = `<table><tr><th>User Email</th><th>Attention (%)</th><th>View Graph</th></tr>`;
-                for (const row of data) {
-                    html += `<tr>
-                        <td>${row.user_email || ''}</td>
-                        <td>${(row.attention_percent).toFixed(2)}</td>
-                        <td><button class="view-graph" onclick="showGraph('${meetId}','${row.user_email}')">View Graph</button></td>
-                    </tr>`;
-                }
-                html += '</table>';
-                document.getElementById('results').innerHTML = html;
-            } catch (error) {
-                console.error('Error fetching data:', error);
-                document.getElementById('results').innerHTML = '<p>Error loading data. Please try again.</p>';
-            }
-        };
-
-        // Modal logic
-        const modal = document.getElementById('graphModal');
-        const closeModal = document.getElementById('closeModal');
-        closeModal.onclick = function() {
-            modal.style.display = 'none';
-            if (chartInstance) { chartInstance.destroy(); chartInstance = null; }
-        };
-        window.onclick = function(event) {
-            if (event.target == modal) {
-                modal.style.display = 'none';
-                if (chartInstance) { chartInstance.destroy(); chartInstance = null; }
-            }
-        };
-
-        // Show graph function
-        async function showGraph(meetingId, userEmail) {
-            modal.style.display = 'block';
-            const chartCanvas = document.getElementById('attentionChart');
-            if (chartInstance) { chartInstance.destroy(); chartInstance = null; }
-            
-            const url = `/api/attention-history?meeting_id=${encodeURIComponent(meetingId)}&user_email=${encodeURIComponent(userEmail)}`;
-            const resp = await fetch(url);
-            const data = await resp.json();
-            
-            if (!data.length) {
-                chartCanvas.getContext('2d').clearRect(0, 0, chartCanvas.width, chartCanvas.height);
-                chartCanvas.getContext('2d').fillText('No data available', 10, 50);
-                return;
-            }
-
-            const labels = data.map(d => new Date(d.timestamp).toLocaleTimeString());
-            const scores = data.map(d => d.attention * 100);
-            
-            chartInstance = new Chart(chartCanvas, {
-                type: 'line',
-                data: {
-                    labels: labels,
-                    datasets: [{
-                        label: 'Attention (%)',
-                        data: scores,
-                        borderColor: '#3498db',
-                        backgroundColor: 'rgba(52, 152, 219, 0.1)',
-                        fill: true,
-                        tension: 0.4
-                    }]
-                },
-                options: {
-                    responsive: true,
-                    maintainAspectRatio: false,
-                    animation: {
-                        duration: 1000,
-                        easing: 'easeInOutQuart'
-                    },
-                    plugins: {
-                        legend: {
-                            position: 'top',
-                        },
-                        title: {
-                            display: true,
-                            text: 'Attention Score Over Time'
-                        }
-                    },
-                    scales: {
-                        y: {
-                            min: 0,
-                            max: 100,
-                            title: {
-                                display: true,
-                                text: 'Attention (%)'
-                            }
-                        },
-                        x: {
-                            title: {
-                                display: true,
-                                text: 'Time'
-                            }
-                        }
-                    }
-                }
-            });
-        }
-        </script>
-    </body>
-    </html>
-    """
+async def db_attention_page(request: Request):
+    if request.headers.get("if-none-match") == DB_ATTENTION_PAGE_ETAG:
+        return Response(status_code=304, headers=DB_ATTENTION_PAGE_HEADERS)
+    return HTMLResponse(content=DB_ATTENTION_PAGE_BYTES, headers=DB_ATTENTION_PAGE_HEADERS)
 
+# The DB read handlers are plain functions so FastAPI runs them in its
+# threadpool; waiting on DB_LOCK there never blocks the event loop
 @app.get("/api/db-attention-data", response_class=JSONResponse)
-async def db_attention_data(meeting_id: str = Query(...)):
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("SELECT user_email, attention_sum, attention_count FROM attention_scores WHERE meeting_id=?", (meeting_id,))
-    rows = c.fetchall()
-    conn.close()
+def db_attention_data(meeting_id: str = Query(...)):
+    with DB_LOCK:
+        rows = DB.execute(SQL_SELECT_SCORES, (meeting_id,)).fetchall()
     result = [
         {
             "user_email": row[0],
-            "attention_percent": (row[1] / row[2] * 100) if row[2] else 0.0
+            "attention_percent": (row[1] / row[2]) if row[2] else 0.0
         }
         for row in rows
     ]
     return result
 
 @app.get("/api/db-attention-score", response_class=JSONResponse)
-async def db_attention_score(meeting_id: str = Query(...), user_email: str = Query(...)):
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute(
-        "SELECT attention_sum, attention_count FROM attention_scores WHERE meeting_id=? AND user_email=?",
-        (meeting_id, user_email)
-    )
-    row = c.fetchone()
-    conn.close()
+def db_attention_score(meeting_id: str = Query(...), user_email: str = Query(...)):
+    with DB_LOCK:
+        row = DB.execute(SQL_SELECT_USER_SCORE, (meeting_id, user_email)).fetchone()
     if row and row[1]:
-        attention_percent = (row[0] / row[1]) * 100
+        attention_percent = row[0] / row[1]
     else:
         attention_percent = 0.0
     return {"user_email": user_email, "attention_percent": attention_percent}
 
 @app.get("/api/attention-history", response_class=JSONResponse)
-async def attention_history(meeting_id: str = Query(...), user_email: str = Query(...)):
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute(
-        "SELECT timestamp, attention FROM attention_history WHERE meeting_id=? AND user_email=? ORDER BY timestamp ASC",
-        (meeting_id, user_email)
-    )
-    rows = c.fetchall()
-    conn.close()
-    return [{"timestamp": ts, "attention": att} for ts, att in rows]
+def attention_history(meeting_id: str = Query(...), user_email: str = Query(...)):
+    with DB_LOCK:
+        rows = DB.execute(SQL_SELECT_HISTORY, (meeting_id, user_email)).fetchall()
+    return [{"timestamp": ts, "attention": att / 100} for ts, att in rows]
 
 if __name__ == "__main__":
     import uvicorn
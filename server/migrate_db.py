@@ -0,0 +1,53 @@
+"""One-off conversion of attention databases to the current schema.
+
+Older databases stored attention as a 0-1 fraction in REAL columns; the server
+now stores integer percentages (schema version 1). Stop the server, then run:
+
+    python server/migrate_db.py
+
+DB_PATH is read from the environment / .env exactly as the server does.
+"""
+import os
+import sqlite3
+from dotenv import load_dotenv
+
+load_dotenv()
+
+DB_PATH = os.getenv('DB_PATH', 'attention_scores.db')
+SCHEMA_VERSION = 1
+
+def migrate(db_path):
+    conn = sqlite3.connect(db_path, isolation_level=None)
+    try:
+        c = conn.cursor()
+        c.execute('BEGIN IMMEDIATE')
+        version = c.execute('PRAGMA user_version').fetchone()[0]
+        tables = {row[0] for row in c.execute("SELECT name FROM sqlite_master WHERE type='table'")}
+        if version >= SCHEMA_VERSION or not {'attention_scores', 'attention_history'} <= tables:
+            c.execute('ROLLBACK')
+            print(f"{db_path} is already at schema version {version}; nothing to do")
+            return
+        print(f"Converting {db_path} from schema version {version} to {SCHEMA_VERSION}...")
+        c.execute('''
+            UPDATE attention_history
+            SET attention = MIN(100, MAX(0, CAST(ROUND(attention * 100) AS INTEGER)))
+        ''')
+        c.execute('''
+            UPDATE attention_scores
+            SET attention = MIN(100, MAX(0, ROUND(attention * 100, 2))),
+                attention_sum = CAST(ROUND(attention_sum * 100) AS INTEGER)
+        ''')
+        # Build the graph index here too, so the first server start doesn't
+        # have to index a large table while booting
+        c.execute('''
+            CREATE INDEX IF NOT EXISTS ix_hist_mid_uemail_ts
+            ON attention_history(meeting_id, user_email, timestamp)
+        ''')
+        c.execute(f'PRAGMA user_version={SCHEMA_VERSION}')
+        c.execute('COMMIT')
+        print("Done")
+    finally:
+        conn.close()
+
+if __name__ == "__main__":
+    migrate(DB_PATH)